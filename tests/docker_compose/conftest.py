@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 import pytest
@@ -19,7 +20,7 @@ def logger():
     return JinaLogger('docker-compose-testing')
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def image_name_tag_map():
     return {
         'reload-executor': '0.13.1',
@@ -49,11 +50,17 @@ def set_test_pip_version():
     del os.environ['JINA_GATEWAY_IMAGE']
 
 
-@pytest.fixture(autouse=True)
+@pytest.fixture(scope='session', autouse=True)
 def build_images(image_name_tag_map):
-    for image in image_name_tag_map.keys():
-        if image != 'jinaai/jina':
-            build_docker_image(image, image_name_tag_map)
+    # the images are independent, build them concurrently
+    images = [image for image in image_name_tag_map.keys() if image != 'jinaai/jina']
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = [
+            executor.submit(build_docker_image, image, image_name_tag_map)
+            for image in images
+        ]
+        for future in futures:
+            future.result()
 
 
 @pytest.fixture
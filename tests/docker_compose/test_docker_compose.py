@@ -1,80 +1,85 @@
 # kind version has to be bumped to v0.11.1 since pytest-kind is just using v0.10.0 which does not work on ubuntu in ci
+import asyncio
+import atexit
+import hashlib
 import os
 import subprocess
-import time
-from typing import Dict, List
 
-import docker
 import pytest
 
 from jina import Document, Flow
+from jina.clients import Client
+from jina.helper import random_port
+from jina.logging.logger import JinaLogger
+
+_teardown_logger = JinaLogger('docker-compose-teardown')
 
 
 class DockerComposeFlow:
 
-    healthy_status = 'healthy'
-    unhealthy_status = 'unhealthy'
+    up_args = ('up', '--build', '-d', '--remove-orphans', '--wait')
+    down_args = ('down', '--remove-orphans')
 
     def __init__(self, dump_path, timeout_second=30):
-        self.dump_path = dump_path
+        self.dump_path = os.fspath(dump_path)
         self.timeout_second = timeout_second
-
-    def __enter__(self):
-        subprocess.run(
-            f'docker-compose -f {self.dump_path} up --build -d --remove-orphans'.split(
-                ' '
+        # unique per dump file, so stacks never remove each other as orphans
+        dump_dir, dump_file = os.path.split(os.path.abspath(self.dump_path))
+        self.project_name = '-'.join(
+            (
+                os.path.splitext(dump_file)[0],
+                hashlib.sha1(dump_dir.encode()).hexdigest()[:8],
             )
         )
+        self._compose_command = (
+            'docker',
+            'compose',
+            '-p',
+            self.project_name,
+            '-f',
+            self.dump_path,
+        )
 
-        container_ids = (
-            subprocess.run(
-                f'docker-compose -f {self.dump_path} ps -q'.split(' '),
-                capture_output=True,
+    def __enter__(self):
+        process = subprocess.run(
+            (
+                *self._compose_command,
+                *self.up_args,
+                '--wait-timeout',
+                str(self.timeout_second),
             )
-            .stdout.decode("utf-8")
-            .split('\n')
         )
-        container_ids.remove('')  # remove empty  return line
-
-        if not container_ids:
-            raise RuntimeError('docker-compose ps did not detect any launch container')
-
-        client = docker.from_env()
-
-        init_time = time.time()
-        healthy = False
-
-        while time.time() - init_time < self.timeout_second:
-            if self._are_all_container_healthy(container_ids, client):
-                healthy = True
-                break
-            time.sleep(0.1)
-
-        if not healthy:
-            raise RuntimeError('Docker containers are not healthy')
-
-    @staticmethod
-    def _are_all_container_healthy(
-        container_ids: List[str], client: docker.client.DockerClient
-    ) -> bool:
+        if process.returncode:
+            # compose leaves the containers running when `up --wait` fails
+            self.__exit__(None, None, None)
+            raise RuntimeError(
+                f'`docker compose up` of project {self.project_name} exited with '
+                f'{process.returncode}'
+            )
 
-        for id_ in container_ids:
-            status = client.containers.get(id_).attrs['State']['Health']['Status']
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # reaped when the test session exits
+        down_process = subprocess.Popen((*self._compose_command, *self.down_args))
+        atexit.register(self._reap_teardown, down_process)
+
+    def _reap_teardown(self, down_process: subprocess.Popen):
+        returncode = down_process.wait()
+        if returncode:
+            _teardown_logger.error(
+                f'`docker compose down` of project {self.project_name} exited with '
+                f'{returncode}, its containers may still be running'
+            )
 
-            if status != DockerComposeFlow.healthy_status:
-                return False
-        return True
+    async def __aenter__(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.__enter__)
+        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        subprocess.run(
-            f'docker-compose -f {self.dump_path} down --remove-orphans'.split(' ')
-        )
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.__exit__(exc_type, exc_val, exc_tb)
 
 
 async def run_test(flow, endpoint, num_docs=10, request_size=10):
     # start port forwarding
-    from jina.clients import Client
-
     client_kwargs = dict(
         host='localhost',
         port=flow.port,
@@ -85,20 +90,21 @@ async def run_test(flow, endpoint, num_docs=10, request_size=10):
 
     client = Client(**client_kwargs)
     client.show_progress = True
-    responses = []
-    async for resp in client.post(
-        endpoint,
-        inputs=[Document() for _ in range(num_docs)],
-        request_size=request_size,
-    ):
-        responses.append(resp)
-
-    return responses
+    return [
+        resp
+        async for resp in client.post(
+            endpoint,
+            inputs=(Document() for _ in range(num_docs)),
+            request_size=request_size,
+        )
+    ]
 
 
 @pytest.fixture()
 def flow_with_sharding(docker_images, polling):
-    flow = Flow(name='test-flow-with-sharding', port=9090, protocol='http').add(
+    flow = Flow(
+        name='test-flow-with-sharding', port=random_port(), protocol='http'
+    ).add(
         name='test_executor_sharding',
         shards=2,
         replicas=2,
@@ -111,7 +117,7 @@ def flow_with_sharding(docker_images, polling):
 
 @pytest.fixture
 def flow_configmap(docker_images):
-    flow = Flow(name='k8s-flow-configmap', port=9091, protocol='http').add(
+    flow = Flow(name='k8s-flow-configmap', port=random_port(), protocol='http').add(
         name='test_executor_configmap',
         uses=f'docker://{docker_images[0]}',
         env={'k1': 'v1', 'k2': 'v2'},
@@ -124,7 +130,7 @@ def flow_with_needs(docker_images):
     flow = (
         Flow(
             name='test-flow-with-needs',
-            port=9092,
+            port=random_port(),
             protocol='http',
         )
         .add(
@@ -151,6 +157,18 @@ def flow_with_needs(docker_images):
     return flow
 
 
+@pytest.fixture
+def flow_with_workspace(docker_images):
+    flow = Flow(
+        name='k8s_flow-with_workspace', port=random_port(), protocol='http'
+    ).add(
+        name='test_executor',
+        uses=f'docker://{docker_images[0]}',
+        workspace='/shared',
+    )
+    return flow
+
+
 @pytest.mark.asyncio
 @pytest.mark.timeout(3600)
 @pytest.mark.parametrize(
@@ -158,26 +176,29 @@ def flow_with_needs(docker_images):
     [['test-executor', 'executor-merger', 'jinaai/jina']],
     indirect=True,
 )
-async def test_flow_with_needs(logger, flow_with_needs, tmpdir, docker_images):
-    dump_path = os.path.join(str(tmpdir), 'docker-compose-flow-with-need.yml')
-    flow_with_needs.to_docker_compose_yaml(dump_path, 'default')
-    with DockerComposeFlow(dump_path):
+async def test_flow_with_needs(flow_with_needs, tmp_path):
+    dump_path = tmp_path / 'docker-compose-flow-with-need.yml'
+    flow_with_needs.to_docker_compose_yaml(str(dump_path), 'default')
+
+    async with DockerComposeFlow(dump_path):
         resp = await run_test(
             flow=flow_with_needs,
             endpoint='/debug',
         )
-        expected_traversed_executors = {
-            'segmenter',
-            'imageencoder',
-            'textencoder',
-        }
 
-        docs = resp[0].docs
-        assert len(docs) == 10
-        for doc in docs:
-            assert set(doc.tags['traversed-executors']) == expected_traversed_executors
+    expected_traversed_executors = frozenset(
+        {'segmenter', 'imageencoder', 'textencoder'}
+    )
+
+    docs = resp[0].docs
+    assert len(docs) == 10
+    for doc in docs:
+        assert (
+            frozenset(doc.tags['traversed-executors']) == expected_traversed_executors
+        )
 
 
+@pytest.mark.asyncio
 @pytest.mark.timeout(3600)
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
@@ -186,11 +207,12 @@ async def test_flow_with_needs(logger, flow_with_needs, tmpdir, docker_images):
     indirect=True,
 )
 @pytest.mark.parametrize('polling', ['ANY', 'ALL'])
-async def test_flow_with_sharding(flow_with_sharding, polling, tmpdir):
-    dump_path = os.path.join(str(tmpdir), 'docker-compose-flow-sharding.yml')
-    flow_with_sharding.to_docker_compose_yaml(dump_path)
+async def test_flow_with_sharding(flow_with_sharding, polling, tmp_path):
+    dump_path = tmp_path / 'docker-compose-flow-sharding.yml'
+    flow_with_sharding.to_docker_compose_yaml(str(dump_path))
 
-    with DockerComposeFlow(dump_path):
+    async with DockerComposeFlow(dump_path):
+        # one request per doc, to reach every shard and replica
         resp = await run_test(
             flow=flow_with_sharding, endpoint='/debug', num_docs=10, request_size=1
         )
@@ -214,19 +236,14 @@ async def test_flow_with_sharding(flow_with_sharding, polling, tmpdir):
             assert set(doc.tags['shard_id']) == {0, 1}
             assert doc.tags['parallel'] == [2, 2]
             assert doc.tags['shards'] == [2, 2]
-            for executor in doc.tags['traversed-executors']:
-                if executor in runtimes_to_visit:
-                    runtimes_to_visit.remove(executor)
         else:
             assert len(set(doc.tags['traversed-executors'])) == 1
             assert len(set(doc.tags['shard_id'])) == 1
             assert 0 in set(doc.tags['shard_id']) or 1 in set(doc.tags['shard_id'])
             assert doc.tags['parallel'] == [2]
             assert doc.tags['shards'] == [2]
-            for executor in doc.tags['traversed-executors']:
-                if executor in runtimes_to_visit:
-                    runtimes_to_visit.remove(executor)
 
+    runtimes_to_visit -= set().union(*(doc.tags['traversed-executors'] for doc in docs))
     assert len(runtimes_to_visit) == 0
 
 
@@ -235,11 +252,11 @@ async def test_flow_with_sharding(flow_with_sharding, polling, tmpdir):
 @pytest.mark.parametrize(
     'docker_images', [['test-executor', 'jinaai/jina']], indirect=True
 )
-async def test_flow_with_configmap(flow_configmap, docker_images, tmpdir):
-    dump_path = os.path.join(str(tmpdir), 'docker-compose-flow-configmap.yml')
-    flow_configmap.to_docker_compose_yaml(dump_path)
+async def test_flow_with_configmap(flow_configmap, tmp_path):
+    dump_path = tmp_path / 'docker-compose-flow-configmap.yml'
+    flow_configmap.to_docker_compose_yaml(str(dump_path))
 
-    with DockerComposeFlow(dump_path):
+    async with DockerComposeFlow(dump_path):
         resp = await run_test(
             flow=flow_configmap,
             endpoint='/env',
@@ -260,19 +277,13 @@ async def test_flow_with_configmap(flow_configmap, docker_images, tmpdir):
     [['test-executor', 'jinaai/jina']],
     indirect=True,
 )
-async def test_flow_with_workspace(logger, docker_images, tmpdir):
-    flow = Flow(name='k8s_flow-with_workspace', port=9090, protocol='http').add(
-        name='test_executor',
-        uses=f'docker://{docker_images[0]}',
-        workspace='/shared',
-    )
-
-    dump_path = os.path.join(str(tmpdir), 'docker-compose-flow-workspace.yml')
-    flow.to_docker_compose_yaml(dump_path)
+async def test_flow_with_workspace(flow_with_workspace, tmp_path):
+    dump_path = tmp_path / 'docker-compose-flow-workspace.yml'
+    flow_with_workspace.to_docker_compose_yaml(str(dump_path))
 
-    with DockerComposeFlow(dump_path):
+    async with DockerComposeFlow(dump_path):
         resp = await run_test(
-            flow=flow,
+            flow=flow_with_workspace,
             endpoint='/workspace',
         )
 